@@ -0,0 +1,296 @@
+"""
+
+Temporal composites of Sentinel-2 L2A items from Planetary Computer
+
+composites:
+- median:  per-band median of all clear observations of a period
+- maxndvi: bands of the observation with the highest NDVI
+
+clouds, cloud shadows and nodata are masked using scene classification (Sen2Cor SCL).
+Items are read window by window with a bounded pool of workers and the composites
+are stored per tile and period as local COGs with overviews. The ids of the items
+used are kept in the COG tags, so only periods with new items are recomputed and
+a composite is never replaced by one built from fewer items.
+
+"""
+
+import os
+import glob
+import tempfile
+import warnings
+import numpy as np
+import rasterio
+import pystac_client
+import planetary_computer as pc
+
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib import colormaps
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds
+from rasterio.windows import bounds as window_bounds
+
+
+COMPOSITE_DIR = "composites"
+STAC_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
+BANDS = ["B02", "B03", "B04", "B08"]
+KINDS = ["median", "maxndvi"]
+# nodata, saturated, cloud shadow, cloud medium/high probability, cirrus
+SCL_MASK = [0, 1, 3, 8, 9, 10]
+SEASONS = {12: "DJF", 1: "DJF", 2: "DJF", 3: "MAM", 4: "MAM", 5: "MAM",
+           6: "JJA", 7: "JJA", 8: "JJA", 9: "SON", 10: "SON", 11: "SON"}
+
+
+def period_key(date, period="month"):
+    """
+    Period of an ISO date: "2023-05" for months or "2023-JJA" for seasons
+    (December belongs to the winter of the following year)
+    """
+    year, month = int(date[:4]), int(date[5:7])
+    if period == "month":
+        return f"{year}-{month:02d}"
+    return f"{year + (month == 12)}-{SEASONS[month]}"
+
+
+def period_order(key):
+    """
+    Sort key of period keys in chronological order
+    """
+    season = key[5:]
+    return int(key[:4]), int(season) if season.isdigit() else ["DJF", "MAM", "JJA", "SON"].index(season)
+
+
+def group_periods(items, period="month"):
+    """
+    Groups STAC items (as dicts) by tile and period
+    """
+    groups = {}
+    for item in items:
+        key = (item["properties"]["s2:mgrs_tile"], period_key(item["properties"]["datetime"], period))
+        groups.setdefault(key, []).append(item)
+    return groups
+
+
+def composite_path(tile, period, kind, out_dir=COMPOSITE_DIR):
+    return os.path.join(out_dir, f"{tile}_{period}_{kind}.tif")
+
+
+def composite_items(path):
+    """
+    Ids of the items a cached composite was built from (empty if there is none)
+    """
+    if not os.path.exists(path):
+        return set()
+    with rasterio.open(path) as src:
+        return set(src.tags().get("items", "").split(",")) - {""}
+
+
+def outdated_periods(groups, out_dir=COMPOSITE_DIR):
+    """
+    Tile/periods with items that are not part of their cached composites yet
+    """
+    return [key for key, items in groups.items()
+            if any(not {item["id"] for item in items} <= composite_items(composite_path(*key, kind, out_dir))
+                   for kind in KINDS)]
+
+
+def fetch_items(ids):
+    """
+    Fetches STAC items (as dicts) by id, e.g. the items of a cached composite
+    missing from the current search
+    """
+    catalog = pystac_client.Client.open(STAC_URL)
+    return catalog.search(collections=["sentinel-2-l2a"], ids=sorted(ids)).item_collection_as_dict()["features"]
+
+
+def cached_periods(tile, kind, period="month", out_dir=COMPOSITE_DIR):
+    """
+    Sorted periods of a tile with a cached composite
+    """
+    periods = []
+    for path in glob.glob(composite_path(tile, "*", kind, out_dir)):
+        key = os.path.basename(path).split("_")[1]
+        if (period == "month") == key[5:].isdigit():
+            periods.append(key)
+    return sorted(periods, key=period_order)
+
+
+def boa_offset(item):
+    """
+    DN offset of the bands of an item: 1000 from processing baseline 04.00 on
+    (since 2022-01-25), 0 before; falls back to the raster:bands offset of the assets
+    """
+    baseline = item["properties"].get("s2:processing_baseline")
+    if baseline is not None:
+        return 1000 if float(baseline) >= 4 else 0
+    band = item["assets"]["B04"].get("raster:bands", [{}])[0]
+    return -band.get("offset", 0) / band.get("scale", 0.0001)
+
+
+def open_item(item):
+    """
+    Opens the band and SCL assets of an item, signed with a fresh token
+    (the SAS token of a cached search result may already be expired),
+    and returns them with the BOA offset of the item
+    """
+    srcs = []
+    try:
+        for asset in BANDS + ["SCL"]:
+            srcs.append(rasterio.open(pc.sign(item["assets"][asset]["href"].split("?")[0])))
+    except Exception:
+        for src in srcs:
+            src.close()
+        raise
+    return srcs[:-1], srcs[-1], boa_offset(item)
+
+
+def read_item(src, window):
+    """
+    Reads the bands of one item within a window of the 10 m grid with the BOA
+    offset removed (valid pixels stay >= 1, as 0 is nodata),
+    pixels masked by SCL or without data are NaN
+    """
+    bands, scl, offset = src
+    data = np.stack([band.read(1, window=window) for band in bands]).astype("float32")
+    scl_window = from_bounds(*window_bounds(window, bands[0].transform), transform=scl.transform)
+    scl_data = scl.read(1, window=scl_window.round_offsets().round_lengths(),
+                        out_shape=(int(window.height), int(window.width)),
+                        resampling=Resampling.nearest)
+    mask = np.isin(scl_data, SCL_MASK) | (data == 0).any(axis=0)
+    data = np.maximum(data - offset, 1)
+    data[:, mask] = np.nan
+    return data
+
+
+def composite_window(stack):
+    """
+    Median and max-NDVI composite of a (time, band, y, x) stack
+    """
+    red, nir = stack[:, BANDS.index("B04")], stack[:, BANDS.index("B08")]
+    with warnings.catch_warnings(), np.errstate(divide="ignore", invalid="ignore"):
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        median = np.nanmedian(stack, axis=0)
+        ndvi = (nir - red) / (nir + red)
+    best = np.argmax(np.where(np.isnan(ndvi), -np.inf, ndvi), axis=0)
+    maxndvi = np.take_along_axis(stack, best[None, None], axis=0)[0]
+    return {"median": median, "maxndvi": maxndvi}
+
+
+def unique_tmp(tile, period, kind, out_dir, tmp_paths):
+    """
+    Creates a unique temp file in out_dir and records its path in tmp_paths
+    """
+    fd, path = tempfile.mkstemp(dir=out_dir, prefix=f".{tile}_{period}_{kind}.", suffix=".tif")
+    os.close(fd)
+    tmp_paths.append(path)
+    return path
+
+
+def build_composite(tile, period, items, out_dir=COMPOSITE_DIR, block_size=512, max_workers=4):
+    """
+    Builds the median and max-NDVI composites of one tile and period
+
+    Parameter
+    ---------
+    tile:           str
+                    MGRS tile of the items
+    period:         str
+                    period key (see period_key)
+    items:          list
+                    STAC items (as dicts) of the tile and period
+    block_size:     int
+                    size of the windows read from all items at once
+    max_workers:    int
+                    number of items read concurrently
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {kind: composite_path(tile, period, kind, out_dir) for kind in KINDS}
+    opened, tmps, tmp_paths = [], {}, []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            opened = [pool.submit(open_item, item) for item in items]
+            srcs = [future.result() for future in opened]
+            ref = srcs[0][0][0]
+            profile = dict(driver="GTiff", width=ref.width, height=ref.height, count=len(BANDS),
+                           dtype="uint16", nodata=0, crs=ref.crs, transform=ref.transform,
+                           tiled=True, blockxsize=512, blockysize=512, compress="deflate")
+            for kind in KINDS:
+                tmps[kind] = rasterio.open(unique_tmp(tile, period, kind, out_dir, tmp_paths), "w", **profile)
+            for row in range(0, ref.height, block_size):
+                for col in range(0, ref.width, block_size):
+                    window = Window(col, row, min(block_size, ref.width - col), min(block_size, ref.height - row))
+                    stack = np.stack(list(pool.map(lambda src: read_item(src, window), srcs)))
+                    for kind, data in composite_window(stack).items():
+                        tmps[kind].write(np.nan_to_num(data).astype("uint16"), window=window)
+            for tmp in tmps.values():
+                tmp.descriptions = tuple(BANDS)
+                tmp.update_tags(tile=tile, period=period, items=",".join(item["id"] for item in items))
+                tmp.close()
+
+        # unique temp files, so concurrent builds of the same tile and period do not share them
+        for kind, path in paths.items():
+            part = unique_tmp(tile, period, kind, out_dir, tmp_paths)
+            rio_copy(tmps[kind].name, part, driver="COG", compress="deflate", overview_resampling="average")
+            os.replace(part, path)
+    finally:
+        for tmp in tmps.values():
+            if not tmp.closed:
+                tmp.close()
+        # the pool is shut down here, so every open has finished
+        for future in opened:
+            if future.exception() is None:
+                bands, scl, _ = future.result()
+                for src in bands + [scl]:
+                    src.close()
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def update_composites(items, period="month", out_dir=COMPOSITE_DIR, max_workers=4):
+    """
+    Builds the composites of all tile/periods with items that are not cached yet,
+    returns the (tile, period) keys that were built
+
+    The items of a cached composite that are missing from the search (e.g. because of
+    a lower cloud cover or a shorter search period) are added again, so a composite
+    only ever grows
+    """
+    groups = group_periods(items, period)
+    outdated = outdated_periods(groups, out_dir)
+    for tile, key in outdated:
+        period_items = groups[(tile, key)]
+        cached = set().union(*(composite_items(composite_path(tile, key, kind, out_dir)) for kind in KINDS))
+        missing = cached - {item["id"] for item in period_items}
+        if missing:
+            period_items = period_items + fetch_items(missing)
+        build_composite(tile, key, period_items, out_dir, max_workers=max_workers)
+    return outdated
+
+
+def composite_overlay(path, display="NDVI", max_size=1024):
+    """
+    Reads a composite from its overviews warped to Web Mercator (the projection of the map)
+    and renders it for an image overlay
+
+    returns a uint8 RGBA image (nodata transparent) and its WGS84 bounds [[south, west], [north, east]]
+    """
+    with rasterio.open(path) as src, WarpedVRT(src, crs="EPSG:3857") as vrt:
+        scale = max(vrt.width / max_size, vrt.height / max_size, 1)
+        data = vrt.read(out_shape=(vrt.count, int(vrt.height / scale), int(vrt.width / scale)),
+                        resampling=Resampling.average, masked=True)
+        west, south, east, north = transform_bounds(vrt.crs, "EPSG:4326", *vrt.bounds)
+    data = data.astype("float32").filled(np.nan)
+
+    if display == "NDVI":
+        red, nir = data[BANDS.index("B04")], data[BANDS.index("B08")]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ndvi = (nir - red) / (nir + red)
+        image = colormaps["brg"]((np.nan_to_num(ndvi) + 1) / 2)
+    else:
+        rgb = np.stack([data[BANDS.index(band)] for band in ["B04", "B03", "B02"]], axis=-1)
+        image = np.dstack([np.clip(np.nan_to_num(rgb) / 3000, 0, 1), np.ones(rgb.shape[:2])])
+    image[..., 3] = np.where(np.isnan(data).any(axis=0), 0, 1)
+    return (image * 255).astype("uint8"), [[south, west], [north, east]]
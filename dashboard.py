@@ -3,10 +3,16 @@ import leafmap.foliumap as leafmap
 import pystac_client
 import planetary_computer as pc
 import datetime
+import itertools
+import os
 import numpy as np
+import folium
+from concurrent.futures import ThreadPoolExecutor
+from leafmap.stac import stac_tile, stac_bounds
 
 
 import streamlit as st
+import composite
 #from streamlit_folium import st_folium
 
 
@@ -20,6 +26,7 @@ eu2_name = 'https://api.ellipsis-drive.com/v3/path/65441cd0-f8cb-4a9a-bfe0-ef1e7
 sib_eve_name = "https://raw.githubusercontent.com/benehiebl/maps_traceve/main/data/sib_cover_eve.wgs84.COG.tif"
 sib_dec_name = "https://raw.githubusercontent.com/benehiebl/maps_traceve/main/data/sib_cover_dec.wgs84.COG.tif"
 sib_class_name = "https://api.ellipsis-drive.com/v3/path/2b46a0fb-bbb8-47fa-84b5-31b707e6ea50/raster/timestamp/e5831b26-33d5-4463-b5e0-f0408004d3b8/tile/{z}/{x}/{y}?style=8dd14ae9%2d5d1a%2d4efe%2dadeb%2db9792b175099&token=epat_uMqm47CrbhbMCKKt9wjGG2IZsPntPh7bHfAl9nxrP1kjpuFd9efOR1zSam6pbyRx"
+stac_name = "https://planetarycomputer.microsoft.com/api/stac/v1"
 
 colors = [(255, 113, 36), (1, 3, 131), (164, 227, 157), (114, 124, 216), (12, 201, 2), (12, 89, 1), (7, 37, 233)]
 labels = ["azonal", "boreal", "mediterranean broad", "mediterranean needle", "submediterranean", "temperate broad", "temperate needle"]
@@ -29,6 +36,102 @@ labels_eu2 = ["evergreen broad-leaved", "deciduous broad-leaved", "evergreen nee
 # To set a webpage title, header and subtitle
 st.set_page_config(page_title = "TRACEVE forest type and cover maps",layout = 'wide')
 
+parks = gpd.read_file(parks_name)[["siteName", "geometry"]]
+
+
+### PLANETARY COMPUTER HELPERS
+def tile_query(collection, tile, cloud_cover):
+        """
+        STAC query for a single Sentinel-2 MGRS tile or Landsat path/row
+        """
+        if collection=="sentinel-2-l2a":
+                return {"s2:mgrs_tile": dict(eq=tile),
+                        "eo:cloud_cover": {"lt": cloud_cover}}
+        return {"landsat:wrs_path": dict(eq=tile[:3]),
+                "landsat:wrs_row": dict(eq=tile[3:]),
+                "eo:cloud_cover": {"lt": cloud_cover}}
+
+
+@st.cache_data(ttl=3600, show_spinner="Searching Planetary Computer...")
+def search_items(collection, tiles, search_period, cloud_cover, bbox=None):
+        """
+        Searches all tiles (or the bbox of an AOI) concurrently and returns the merged,
+        de-duplicated items grouped by acquisition date (ascending)
+        """
+        catalog = pystac_client.Client.open(stac_name, modifier=pc.sign_inplace)
+        if bbox is not None:
+                queries = [dict(bbox=bbox, query={"eo:cloud_cover": {"lt": cloud_cover}})]
+        else:
+                queries = [dict(query=tile_query(collection, tile, cloud_cover)) for tile in tiles]
+
+        def search(query):
+                return catalog.search(collections=[collection],
+                                      datetime=list(search_period),
+                                      **query).item_collection_as_dict()["features"]
+
+        with ThreadPoolExecutor(max_workers=min(max(len(queries), 1), 8)) as pool:
+                features = itertools.chain.from_iterable(pool.map(search, queries))
+                items = {item["id"]: item for item in features}
+
+        dates = {}
+        for item in sorted(items.values(), key=lambda item: item["properties"]["datetime"]):
+                dates.setdefault(item["properties"]["datetime"][:10], []).append(item)
+        return dates
+
+
+@st.cache_resource
+def prefetch_pool():
+        return ThreadPoolExecutor(max_workers=4)
+
+
+def stac_layer_metadata(collection, item, kwargs):
+        """
+        Tile url and bounds of a STAC item from the Planetary Computer titiler endpoint
+        """
+        tile_url = stac_tile(collection=collection, item=item, titiler_endpoint="planetary-computer", **kwargs)
+        bounds = stac_bounds(collection=collection, item=item, titiler_endpoint="planetary-computer")
+        return tile_url, bounds
+
+
+def prefetch_key(collection, item, kwargs):
+        return (collection, item, tuple(sorted(kwargs.items())))
+
+
+def prefetch_stac_layer(collection, item, kwargs):
+        """
+        Submits the metadata request of a STAC item to the background pool once per session
+        (failed requests are resubmitted) and returns its future
+        """
+        key = prefetch_key(collection, item, kwargs)
+        prefetched = st.session_state.setdefault("stac_prefetch", {})
+        if key not in prefetched or (prefetched[key].done() and prefetched[key].exception() is not None):
+                prefetched[key] = prefetch_pool().submit(stac_layer_metadata, collection, item, kwargs)
+        return prefetched[key]
+
+
+def band_layer(collection, band):
+        """
+        STAC layer arguments and layer name for a band, band combination, NDVI or an expression
+        """
+        if band.startswith("exp:"):
+                return dict(expression=band[4:],
+                            rescale="-1,1",
+                            colormap_name="reds"), band
+        if band=="NDVI":
+                return dict(expression="(B08-B04)/(B08+B04)" if collection=="sentinel-2-l2a" else "(nir08-red)/(nir08+red)",
+                            rescale="-1,1",
+                            colormap_name="brg",
+                            vmin=0, vmax=1), "NDVI"
+        return dict(assets=band), str(band)
+
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def load_composite(path, mtime, display):
+        """
+        Image overlay of a local composite (mtime invalidates the cache when it is rebuilt)
+        """
+        return composite.composite_overlay(path, display)
+
 #st.subheader("Interact with this dashboard using the widgets on the sidebar")
 #st.markdown("- **forest type maps were produced based on Italian Forest Vegetation Base and annual Sentinel-2 time series from 2017 to 2023 using an InceptionTime ensemble**\n" \
 #            "- **cover maps were produced using the Vegetation Plot observation collected in Sibillini and Gennargentu Nationalpark and an aggregated annual Sentinel-2 time series**\n\n" \
@@ -51,7 +154,8 @@ with side.container(border=True):
                 #with st.form(key="my_form"):
                 collection = st.selectbox("Planetary Computer Collection", ("sentinel-2-l2a", "landsat-c2-l2"))
                 #if collection=="sentinel-2-l2a":
-                tile = st.text_input("Tile/Pathrow (Sibillini 33TUH/190031/190030/191030, Gennargentu 32TNK/192032)", "33TUH" if collection=="sentinel-2-l2a" else "192032")
+                tile = st.text_input("Tiles/Pathrows, comma separated (Sibillini 33TUH/190031/190030/191030, Gennargentu 32TNK/192032)", "33TUH" if collection=="sentinel-2-l2a" else "192032")
+                aoi = st.selectbox("or search the AOI of a park", parks.siteName, index=None, placeholder="Use tiles")
                 #elif collection=="landsat-c2-l2":
                         #path = st.text_input("Path (Sibillini 190/, Gennargentu 132)", "33TUH")
                         #row = st.text_input("Sentinel-2 tile (Sibillini 33TUH, Gennargentu 32TNK)", "33TUH")
@@ -64,42 +168,50 @@ with side.container(border=True):
         show_sat = st.checkbox("Show Sat Imagery")
 
         if show_sat:
+                tiles = [t.strip() for t in tile.replace(";", ",").split(",") if t.strip()]
+                bbox = None
+                if aoi is not None:
+                        bbox = tuple(float(b) for b in parks[parks.siteName==aoi].to_crs(4326).total_bounds)
                 try:
-                        catalog = pystac_client.Client.open(
-                                "https://planetarycomputer.microsoft.com/api/stac/v1",
-                                modifier=pc.sign_inplace)
-
-                        if collection=="sentinel-2-l2a":
-                                search = catalog.search(
-                                        collections=[collection],
-                                        query = {"s2:mgrs_tile": dict(eq=tile),
-                                                "eo:cloud_cover": {"lt": cloud_cover}},
-                                        datetime=[search_period[0], search_period[1]],
-                                        )
-                        elif collection=="landsat-c2-l2":
-                                search = catalog.search(
-                                        collections=[collection],
-                                        query = {"landsat:wrs_path": dict(eq=tile[:3]),
-                                                "landsat:wrs_row": dict(eq=tile[3:]),
-                                                "eo:cloud_cover": {"lt": cloud_cover}},
-                                        datetime=[search_period[0], search_period[1]],
-                                        )
-
-                        ic = search.item_collection_as_dict()
+                        sat_dates = search_items(collection, tuple(tiles), tuple(search_period), cloud_cover, bbox)
                 except:
+                        sat_dates = {}
                         st.markdown("Sometimes Planetary Computer does not like us...The request exceeded the maximum allowed time. Please try again later!")
 
-
-                st.markdown(f'**Found {len(ic["features"])} items for {tile}**')
-                if len(ic["features"])>1:
-                        n_sat = st.slider("", min_value=1, max_value=len(ic["features"]), value=1)
+                dates = list(sat_dates)
+                st.markdown(f'**Found {sum(len(items) for items in sat_dates.values())} items on {len(dates)} dates for {aoi or ", ".join(tiles)}**')
+                if len(dates)>1:
+                        n_sat = st.slider("", min_value=1, max_value=len(dates), value=1)
                 else: n_sat = 1
-                n_sat = (len(ic["features"])+1) - n_sat
-                st.markdown(f'**Selected Item:    {ic["features"][n_sat-1]["properties"]["datetime"][:10]}**')
+                if dates:
+                        st.markdown(f'**Selected Date:    {dates[n_sat-1]}**')
                 pos_bands = [["B02", "B03", "B04", "B05", "B06", "B06", "B07", "B08", "B11", "B12", "SCL", "NDVI"], 
                         ["red", "blue", "green", "nir08", "swir16", "swir22", "NDVI"]]
                 #band = st.multiselect("Bands", pos_bands[0] if collection=="sentinel-2-l2a" else pos_bands[1], default="NDVI")
                 band = st.text_input("Band, Band Combination, NDVI or an expression", "NDVI")
+
+        show_comp = show_sat and collection=="sentinel-2-l2a" and st.checkbox("Show Composites")
+
+        if show_comp:
+                comp_period = st.selectbox("Composite period", ("month", "season"))
+                comp_kind = st.selectbox("Composite", composite.KINDS, format_func=lambda kind: "Median" if kind=="median" else "Max NDVI")
+                comp_display = st.selectbox("Composite display", ("NDVI", "True Color"))
+                if st.button("Update composites for search"):
+                        try:
+                                with st.spinner("Building composites of periods with new items..."):
+                                        built = composite.update_composites(list(itertools.chain.from_iterable(sat_dates.values())), comp_period)
+                                st.markdown(f'**Updated composites of {len(built)} periods with new items, all others were cached**')
+                        except:
+                                st.markdown("Sometimes Planetary Computer does not like us...Building the composites failed. Please try again later!")
+
+                comp_tiles = sorted({item["properties"]["s2:mgrs_tile"] for items in sat_dates.values() for item in items})
+                comp_periods = sorted({period for comp_tile in comp_tiles for period in composite.cached_periods(comp_tile, comp_kind, comp_period)}, key=composite.period_order)
+                if len(comp_periods)>1:
+                        sel_period = st.select_slider("Composite period shown", options=comp_periods, value=comp_periods[-1])
+                elif comp_periods: sel_period = comp_periods[0]
+                else:
+                        sel_period = None
+                        st.markdown("**No composites yet, update composites for the search first**")
                 
 
 
@@ -114,36 +226,53 @@ m = leafmap.Map(basemap="Esri.WorldImagery", height=2000)#, height="1000px", wid
 m.add_basemap("Esri.WorldTopoMap")
 m.add_basemap("Esri.WorldImagery")
 
-if show_sat:
+if show_sat and dates:
+        layer_kwargs, layer_name = band_layer(collection, band)
+        sel_items = sat_dates[dates[n_sat-1]]
+        neighbours = [item for date in dates[max(n_sat-2, 0):n_sat+1] if date!=dates[n_sat-1] for item in sat_dates[date]]
+        # request the selected date first and the neighbouring dates after it in the background,
+        # so stepping the slider is instant without the selected layer queueing behind its neighbours
+        for item in sel_items + neighbours:
+                prefetch_stac_layer(collection, item["id"], layer_kwargs)
+        keep = {prefetch_key(collection, item["id"], layer_kwargs) for item in sel_items + neighbours}
+        prefetched = st.session_state["stac_prefetch"]
+        for key in set(prefetched) - keep:
+                prefetched.pop(key).cancel()
+
+        sel_bounds = []
+        for item in sel_items:
+                try:
+                        tile_url, bounds = prefetch_stac_layer(collection, item["id"], layer_kwargs).result()
+                except:
+                        st.markdown("Sometimes Planetary Computer does not like us...The request exceeded the maximum allowed time. Please try again later!")
+                        continue
+                m.add_tile_layer(tile_url,
+                        name=layer_name if len(sel_items)==1 else f"{layer_name} {item['id']}",
+                        attribution=".")
+                sel_bounds.append(bounds)
+        if sel_bounds:
+                m.fit_bounds([[min(b[1] for b in sel_bounds), min(b[0] for b in sel_bounds)],
+                              [max(b[3] for b in sel_bounds), max(b[2] for b in sel_bounds)]])
+
         if band.startswith("exp:"):
                 st.write(band[4:])
-                m.add_stac_layer(collection=collection,
-                        item=ic["features"][n_sat-1]["id"],
-                        expression=band[4:],
-                        rescale="-1,1",
-                        colormap_name="reds",
-                        #vmin=0, vmax=1,
-                        name=band)  
                 m.add_colormap(label=band,
                                 cmap="Reds",
                                 vmin=-1, vmax=1, position=(25,1), width=3, height=0.2, label_size=9, transparent=True)
-        if band=="NDVI":
-                m.add_stac_layer(collection=collection,
-                        item=ic["features"][n_sat-1]["id"],
-                        expression="(B08-B04)/(B08+B04)" if collection=="sentinel-2-l2a" else "(nir08-red)/(nir08+red)",
-                        rescale="-1,1",
-                        colormap_name="brg",
-                        vmin=0, vmax=1,
-                        name="NDVI")  
+        elif band=="NDVI":
                 m.add_colormap(label="NDVI",
                                 cmap="brg",
                                 vmin=-1, vmax=1, position=(25,1), width=3, height=0.2, label_size=9, transparent=True)
-        else:
-                m.add_stac_layer(collection=collection,
-                        item=ic["features"][n_sat-1]["id"],
-                        #expression=band,
-                        assets=band,
-                        name=str(band))
+
+if show_comp and sel_period:
+        for comp_tile in comp_tiles:
+                comp_path = composite.composite_path(comp_tile, sel_period, comp_kind)
+                if not os.path.exists(comp_path):
+                        continue
+                image, bounds = load_composite(comp_path, os.path.getmtime(comp_path), comp_display)
+                folium.raster_layers.ImageOverlay(image,
+                        bounds=bounds,
+                        name=f"{comp_tile} {sel_period} {comp_kind}").add_to(m)
 
 m.add_tile_layer(url=eu2_name,
                   name="Gennargentu EU2 forest type",
@@ -181,7 +310,6 @@ m.add_cog_layer(sib_dec_name,
         colormap_name="greens",
         name="Sibillini Cover DEC")
 
-parks = gpd.read_file(parks_name)[["siteName", "geometry"]]
 style = {"fillColor": "#00000000"}
 m.add_gdf(parks, layer_name="Parks", style_callback=lambda x: style)
 